@@ -2,12 +2,17 @@ import streamlit as st
 import google.generativeai as genai
 from PIL import Image
 import time
+import random
 import hashlib
 from datetime import datetime, timedelta
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import orjson
 import base64
 import io
+import diskcache
+from collections import OrderedDict
+from string import Template
 
 # Page configuration
 st.set_page_config(
@@ -41,48 +46,157 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# Reply style options and the prompt they feed into
+MOOD_INSTRUCTIONS = {
+    "🔥 Flirty & Playful": "Generate flirty, playful, and charming replies with subtle teasing and romantic undertones. Be confident and engaging.",
+    "❤️ Romantic & Sweet": "Generate sweet, romantic, and heartfelt replies that show genuine affection and care.",
+    "😎 Casual & Friendly": "Generate casual, friendly, and relaxed replies as if talking to a good friend.",
+    "💼 Professional & Formal": "Generate professional, formal, and polished replies suitable for work environments.",
+    "🤝 Business Networking": "Generate professional networking replies that build rapport and maintain business relationships.",
+    "😂 Humorous & Witty": "Generate funny, witty, and clever replies that will make them laugh.",
+    "🧊 Cold & Detached": "Generate brief, distant, and emotionally detached replies.",
+    "🔥 Bold & Confident": "Generate bold, assertive, and confident replies that command respect.",
+    "🤔 Thoughtful & Deep": "Generate thoughtful, introspective, and meaningful replies.",
+    "😌 Supportive & Caring": "Generate supportive, empathetic, and caring replies that show understanding."
+}
+
+LENGTH_GUIDE = {
+    "Short": "Keep replies brief (1-2 sentences)",
+    "Medium": "Make replies moderate length (2-3 sentences)",
+    "Long": "Create detailed, expressive replies (3-5 sentences)"
+}
+
+PROMPT_TEMPLATE = Template("""You are an expert communication specialist. Analyze the conversation and generate $num_suggestions different reply suggestions.
+
+Mood/Tone: $mood
+Reply Length: $length
+
+Additional Context: $context
+
+Instructions:
+1. Read the conversation carefully
+2. Generate $num_suggestions unique replies matching the mood and length
+3. Make replies natural and contextually appropriate
+4. Number each suggestion
+5. Add brief reason after each
+
+Format:
+**Reply 1:**
+[Your reply]
+*Why it works: [Brief explanation]*
+
+**Reply 2:**
+[Your reply]
+*Why it works: [Brief explanation]*
+
+""")
+
+# Maximum number of responses kept in the session cache
+MAX_CACHE = 256
+
+# How long cached responses stay valid, in seconds (memory and disk)
+CACHE_TTL = 3600
+
 # Initialize session state for caching and rate limiting
 if 'request_cache' not in st.session_state:
-    st.session_state.request_cache = {}
-if 'request_history' not in st.session_state:
-    st.session_state.request_history = []
+    st.session_state.request_cache = OrderedDict()
+if 'rl_buckets' not in st.session_state:
+    st.session_state.rl_buckets = [0] * 6
+    st.session_state.rl_head = 0
+    st.session_state.rl_last = time.monotonic()
 if 'retry_count' not in st.session_state:
     st.session_state.retry_count = 0
 
+# Shared HTTP session so Ollama calls reuse pooled connections across reruns
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+    session.headers.update({
+        "User-Agent": "TextWiz-AI",
+        "Content-Type": "application/json"
+    })
+    return session
+
+_HTTP = get_http_session()
+
+# On-disk response cache shared across sessions and reconnects
+@st.cache_resource
+def get_disk_cache():
+    return diskcache.Cache(".textwiz_cache", size_limit=256 * 1024 * 1024)
+
+_DC = get_disk_cache()
+
+# Build the Gemini model once per API key and reuse it across retries and reruns.
+# Bounded so visitors' keys and models don't stay in memory indefinitely.
+@st.cache_resource(max_entries=16, ttl=3600)
+def get_model(api_key, model_name):
+    genai.configure(api_key=api_key)
+    
+    generation_config = {
+        "temperature": 0.7,
+        "top_p": 0.95,
+        "max_output_tokens": 2048,
+    }
+    
+    return genai.GenerativeModel(
+        model_name=model_name,
+        generation_config=generation_config
+    )
+
 # Function to encode image to base64
 def encode_image(image):
     buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
+    image.save(buffered, format="JPEG", quality=85, optimize=True)
     return base64.b64encode(buffered.getvalue()).decode('utf-8')
 
 # Function to call Ollama API
-def generate_with_ollama(model, prompt, image_base64=None):
+def generate_with_ollama(model, prompt, image_base64=None, on_chunk=None):
     url = "http://localhost:11434/api/generate"
     
     payload = {
         "model": model,
         "prompt": prompt,
-        "stream": False
+        "stream": True
     }
     
     if image_base64:
         payload["images"] = [image_base64]
     
     try:
-        response = requests.post(url, json=payload, timeout=120)
-        response.raise_for_status()
-        return response.json()["response"]
+        # Session already sends Content-Type: application/json
+        with _HTTP.post(url, data=orjson.dumps(payload), stream=True, timeout=120) as response:
+            response.raise_for_status()
+            # Ollama streams one JSON object per line; keep only the text
+            parts = []
+            last_update = time.monotonic()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = orjson.loads(line)
+                if "error" in chunk:
+                    raise Exception(chunk["error"])
+                parts.append(chunk.get("response", ""))
+                # Lines are roughly one token each, so refresh the preview
+                # at most every 100 ms instead of re-joining per token
+                if on_chunk and time.monotonic() - last_update >= 0.1:
+                    on_chunk("".join(parts))
+                    last_update = time.monotonic()
+                if chunk.get("done"):
+                    break
+        return "".join(parts)
     except requests.exceptions.ConnectionError:
         raise Exception("Cannot connect to Ollama. Make sure Ollama is running (ollama serve)")
     except Exception as e:
         raise Exception(f"Ollama error: {str(e)}")
 
-# Function to check Ollama availability
+# Function to check Ollama availability (cached so reruns skip the HTTP call)
+@st.cache_data(ttl=30, show_spinner=False)
 def check_ollama():
     try:
-        response = requests.get("http://localhost:11434/api/tags", timeout=2)
+        response = _HTTP.get("http://localhost:11434/api/tags", timeout=2)
         if response.status_code == 200:
-            models = response.json().get("models", [])
+            models = orjson.loads(response.content).get("models", [])
             return True, [model["name"] for model in models]
         return False, []
     except:
@@ -97,45 +211,90 @@ class GeminiAgentSystem:
         self.use_ollama_fallback = False
         self.ollama_model = None
         
-    def get_cache_key(self, prompt, mood, length):
-        """Generate cache key for request"""
-        content = f"{prompt}_{mood}_{length}"
-        return hashlib.md5(content.encode()).hexdigest()
+    def get_cache_key(self, prompt, mood, length, image_hash=None):
+        """Generate cache key for request, including the image contents"""
+        h = hashlib.blake2b(digest_size=16)
+        h.update(prompt.encode())
+        h.update(b"\x1f")
+        h.update(mood.encode())
+        h.update(b"\x1f")
+        h.update(str(length).encode())
+        h.update(b"\x1f")
+        h.update((image_hash or "").encode())
+        return h.hexdigest()
+    
+    def request_cache_key(self, prompt, num_suggestions, image=None, image_hash=None):
+        """Cache key for a request. Image prompts are identical text, so the
+        key must carry the image contents or replies leak across uploads"""
+        if image is not None and image_hash is None:
+            image_hash = hashlib.blake2b(image.tobytes(), digest_size=16).hexdigest()
+        return self.get_cache_key(prompt, self.primary_model, num_suggestions, image_hash)
     
     def check_cache(self, cache_key):
-        """Check if response exists in cache"""
-        if cache_key in st.session_state.request_cache:
-            cached_data = st.session_state.request_cache[cache_key]
-            # Cache valid for 1 hour
-            if datetime.now() - cached_data['timestamp'] < timedelta(hours=1):
+        """Check session cache first, then the on-disk cache"""
+        cache = st.session_state.request_cache
+        if cache_key in cache:
+            cache.move_to_end(cache_key)
+            cached_data = cache[cache_key]
+            if datetime.now() - cached_data['timestamp'] < timedelta(seconds=CACHE_TTL):
                 return cached_data['response']
-        return None
+            del cache[cache_key]
+        
+        # Disk cache handles its own expiry
+        response, expire_time = _DC.get(cache_key, expire_time=True)
+        if response is not None:
+            self._remember(cache_key, response, datetime.fromtimestamp(expire_time) - timedelta(seconds=CACHE_TTL))
+        return response
     
     def save_to_cache(self, cache_key, response):
-        """Save response to cache"""
-        st.session_state.request_cache[cache_key] = {
+        """Save response to session and disk caches"""
+        self._remember(cache_key, response, datetime.now())
+        _DC.set(cache_key, response, expire=CACHE_TTL)
+    
+    def _remember(self, cache_key, response, timestamp):
+        """Store in session cache, evicting the least recently used entry"""
+        cache = st.session_state.request_cache
+        cache[cache_key] = {
             'response': response,
-            'timestamp': datetime.now()
+            'timestamp': timestamp
         }
+        cache.move_to_end(cache_key)
+        if len(cache) > MAX_CACHE:
+            cache.popitem(last=False)
     
-    def rate_limit_check(self):
-        """Check if we're making too many requests"""
-        now = datetime.now()
-        # Keep only requests from last minute
-        st.session_state.request_history = [
-            req_time for req_time in st.session_state.request_history 
-            if now - req_time < timedelta(minutes=1)
-        ]
+    def requests_in_window(self):
+        """Advance the sliding window to now and return requests in the last minute"""
+        buckets = st.session_state.rl_buckets
         
+        # Advance the head, zeroing buckets that slid out of the window
+        steps = int((time.monotonic() - st.session_state.rl_last) // 10)
+        for _ in range(min(steps, len(buckets))):
+            st.session_state.rl_head = (st.session_state.rl_head + 1) % len(buckets)
+            buckets[st.session_state.rl_head] = 0
+        st.session_state.rl_last += steps * 10
+        
+        return sum(buckets)
+    
+    def rate_limit_check(self):
+        """Sliding window of six 10-second buckets covering the last minute"""
         # Gemini free tier: 15 RPM for flash, 60 RPM for 2.0-flash-exp
         # Set conservative limit at 50 to stay safe
-        if len(st.session_state.request_history) >= 50:
-            return False, 60 - (now - st.session_state.request_history[0]).seconds
+        buckets = st.session_state.rl_buckets
+        total = self.requests_in_window()
+        now = time.monotonic()
+        
+        if total >= 50:
+            # Wait until enough of the oldest buckets have slid out
+            for k in range(1, len(buckets) + 1):
+                total -= buckets[(st.session_state.rl_head + k) % len(buckets)]
+                if total < 50:
+                    return False, st.session_state.rl_last + k * 10 - now
         return True, 0
     
-    def log_request(self):
-        """Log request timestamp"""
-        st.session_state.request_history.append(datetime.now())
+    def record_request(self):
+        """Count a request in the bucket for the current time"""
+        self.requests_in_window()
+        st.session_state.rl_buckets[st.session_state.rl_head] += 1
     
     def optimize_prompt(self, prompt, num_suggestions):
         """Optimize prompt to reduce token usage"""
@@ -153,23 +312,25 @@ class GeminiAgentSystem:
         return "Ollama"
     
     def exponential_backoff(self, attempt):
-        """Calculate wait time with exponential backoff"""
-        return min(self.base_delay * (2 ** attempt), 60)
+        """Calculate wait time with exponential backoff and equal jitter"""
+        expo = min(self.base_delay * (2 ** attempt), 60)
+        return random.uniform(expo / 2, expo)
     
-    def generate_with_retry(self, prompt, image=None, num_suggestions=3):
+    def generate_with_retry(self, prompt, image=None, num_suggestions=3, image_hash=None):
         """Main agent function with intelligent retry logic"""
         
-        # Step 1: Check cache first
-        cache_key = self.get_cache_key(prompt, self.primary_model, num_suggestions)
+        # Step 1: Check cache first (silent, so a hit draws no status messages)
+        cache_key = self.request_cache_key(prompt, num_suggestions, image, image_hash)
         cached_response = self.check_cache(cache_key)
         if cached_response:
-            st.info("✨ Using cached response")
             return cached_response, "cache"
         
         # Step 2: Rate limit check (silent)
         can_proceed, wait_time = self.rate_limit_check()
         if not can_proceed:
             time.sleep(wait_time)
+        # Counted after any wait, in the bucket the request actually runs in
+        self.record_request()
         
         # Step 3: Optimize prompt
         optimized_prompt = self.optimize_prompt(prompt, num_suggestions)
@@ -181,34 +342,41 @@ class GeminiAgentSystem:
             try:
                 st.info(f"🤖 Generating with Gemini 2.0 Flash...")
                 
-                # Configure model with safety settings
-                genai.configure(api_key=st.session_state.api_key)
-                
-                generation_config = {
-                    "temperature": 0.7,
-                    "top_p": 0.95,
-                    "max_output_tokens": 2048,
-                }
-                
-                model = genai.GenerativeModel(
-                    model_name=self.primary_model,
-                    generation_config=generation_config
-                )
+                # Cached after the first call; failures still reach the fallback
+                model = get_model(st.session_state.api_key, self.primary_model)
                 
-                # Generate response
+                # Stream response and render it as it arrives
                 if image:
-                    response = model.generate_content([optimized_prompt, image])
+                    response = model.generate_content([optimized_prompt, image], stream=True)
                 else:
-                    response = model.generate_content(optimized_prompt)
+                    response = model.generate_content(optimized_prompt, stream=True)
                 
-                # Check if response was blocked
-                if not response.text:
-                    raise Exception("Response was blocked or empty")
+                placeholder = st.empty()
+                buf = []
+                last_update = time.monotonic()
+                try:
+                    for chunk in response:
+                        # The final chunk often carries only finish_reason and
+                        # no parts, where chunk.text would raise
+                        if not chunk.candidates or not chunk.candidates[0].content.parts:
+                            continue
+                        buf.append(chunk.text)
+                        # Refresh the preview at most every 100 ms
+                        if time.monotonic() - last_update >= 0.1:
+                            placeholder.markdown("".join(buf))
+                            last_update = time.monotonic()
+                finally:
+                    placeholder.empty()
                 
-                result = response.text
+                # Check if response was blocked
+                if response.prompt_feedback.block_reason or any(
+                    candidate.finish_reason.name == "SAFETY" for candidate in response.candidates
+                ):
+                    raise Exception("Response was blocked by safety filters")
                 
-                # Log successful request
-                self.log_request()
+                result = "".join(buf)
+                if not result:
+                    raise Exception("Response was empty")
                 
                 # Save to cache
                 self.save_to_cache(cache_key, result)
@@ -254,9 +422,14 @@ class GeminiAgentSystem:
                 # Encode image if present
                 image_base64 = None
                 if image:
-                    image_base64 = encode_image(image)
+                    image_base64 = st.session_state.get('img_b64') or encode_image(image)
                 
-                result = generate_with_ollama(self.ollama_model, optimized_prompt, image_base64)
+                placeholder = st.empty()
+                try:
+                    result = generate_with_ollama(self.ollama_model, optimized_prompt, image_base64,
+                                                  on_chunk=placeholder.markdown)
+                finally:
+                    placeholder.empty()
                 
                 if result:
                     result_with_note = result + "\n\n*Generated using Ollama (local)*"
@@ -283,6 +456,27 @@ class GeminiAgentSystem:
 # Initialize agent system
 agent = GeminiAgentSystem()
 
+# Build the prompt for the current inputs and hand it to the agent
+def generate_replies(conversation_text, mood, reply_length, num_suggestions,
+                     additional_context, image_hash, image=None):
+    # Prepare the prompt
+    prompt = PROMPT_TEMPLATE.substitute(
+        num_suggestions=num_suggestions,
+        mood=MOOD_INSTRUCTIONS[mood],
+        length=LENGTH_GUIDE[reply_length],
+        context=additional_context if additional_context else "None"
+    )
+    
+    # Add conversation context
+    if image:
+        prompt += "\n\nAnalyze the conversation in the image."
+        if conversation_text:
+            prompt += f"\n\nAdditional text:\n{conversation_text}"
+    else:
+        prompt += f"\n\nConversation:\n{conversation_text}"
+    
+    return agent.generate_with_retry(prompt, image, num_suggestions, image_hash)
+
 # Header
 st.markdown('<h1 class="main-header">✨ TextWiz AI</h1>', unsafe_allow_html=True)
 st.markdown('<p class="subtitle">Your AI-powered reply expert for every conversation</p>', unsafe_allow_html=True)
@@ -313,9 +507,8 @@ with st.sidebar:
     st.divider()
     
     st.header("🤖 AI Agent Status")
-    if 'request_history' in st.session_state:
-        recent_requests = len([t for t in st.session_state.request_history 
-                              if datetime.now() - t < timedelta(minutes=1)])
+    if 'rl_buckets' in st.session_state:
+        recent_requests = agent.requests_in_window()
         st.metric("Requests (last min)", f"{recent_requests}/50")
         
         # Show rate limit warning
@@ -330,8 +523,14 @@ with st.sidebar:
     st.metric("Cached Responses", cached_items)
     
     if st.button("🗑️ Clear Cache"):
-        st.session_state.request_cache = {}
-        st.session_state.request_history = []
+        # The disk cache is shared by all sessions; only drop this session's entries
+        for cache_key in st.session_state.request_cache:
+            _DC.delete(cache_key)
+        st.session_state.request_cache = OrderedDict()
+        check_ollama.clear()
+        st.session_state.rl_buckets = [0] * 6
+        st.session_state.rl_head = 0
+        st.session_state.rl_last = time.monotonic()
         st.success("Cache cleared!")
     
     st.divider()
@@ -339,18 +538,7 @@ with st.sidebar:
     st.header("📊 Reply Style")
     mood = st.selectbox(
         "Select Mood/Tone",
-        [
-            "🔥 Flirty & Playful",
-            "❤️ Romantic & Sweet",
-            "😎 Casual & Friendly",
-            "💼 Professional & Formal",
-            "🤝 Business Networking",
-            "😂 Humorous & Witty",
-            "🧊 Cold & Detached",
-            "🔥 Bold & Confident",
-            "🤔 Thoughtful & Deep",
-            "😌 Supportive & Caring"
-        ]
+        list(MOOD_INSTRUCTIONS)
     )
     
     reply_length = st.select_slider(
@@ -389,8 +577,26 @@ with tab1:
     )
     
     if uploaded_file:
-        uploaded_image = Image.open(uploaded_file)
+        # Process each upload once, not on every rerun
+        if st.session_state.get('img_file_id') != uploaded_file.file_id:
+            image = Image.open(uploaded_file)
+            full_size = image.size
+            # Chat text stays legible at 1600px and the payload shrinks a lot
+            image.thumbnail((1600, 1600), Image.LANCZOS)
+            image = image.convert("RGB")
+            st.session_state.img_file_id = uploaded_file.file_id
+            st.session_state.img = image
+            st.session_state.img_hash = hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+            # PNG/JPEG uploads that needed no resize are sent to Ollama as-is
+            if image.size == full_size:
+                st.session_state.img_b64 = base64.b64encode(uploaded_file.getvalue()).decode('utf-8')
+            else:
+                st.session_state.img_b64 = encode_image(image)
+        uploaded_image = st.session_state.img
         st.image(uploaded_image, caption="Uploaded Screenshot", use_container_width=True)
+    else:
+        for key in ('img_file_id', 'img', 'img_hash', 'img_b64'):
+            st.session_state.pop(key, None)
 
 with tab2:
     st.subheader("Enter Conversation Text")
@@ -420,64 +626,15 @@ if st.button("✨ Generate Replies", type="primary", use_container_width=True):
     else:
         with st.spinner("✨ Creating perfect replies..."):
             try:
-                # Prepare the prompt
-                mood_instructions = {
-                    "🔥 Flirty & Playful": "Generate flirty, playful, and charming replies with subtle teasing and romantic undertones. Be confident and engaging.",
-                    "❤️ Romantic & Sweet": "Generate sweet, romantic, and heartfelt replies that show genuine affection and care.",
-                    "😎 Casual & Friendly": "Generate casual, friendly, and relaxed replies as if talking to a good friend.",
-                    "💼 Professional & Formal": "Generate professional, formal, and polished replies suitable for work environments.",
-                    "🤝 Business Networking": "Generate professional networking replies that build rapport and maintain business relationships.",
-                    "😂 Humorous & Witty": "Generate funny, witty, and clever replies that will make them laugh.",
-                    "🧊 Cold & Detached": "Generate brief, distant, and emotionally detached replies.",
-                    "🔥 Bold & Confident": "Generate bold, assertive, and confident replies that command respect.",
-                    "🤔 Thoughtful & Deep": "Generate thoughtful, introspective, and meaningful replies.",
-                    "😌 Supportive & Caring": "Generate supportive, empathetic, and caring replies that show understanding."
-                }
-                
-                length_guide = {
-                    "Short": "Keep replies brief (1-2 sentences)",
-                    "Medium": "Make replies moderate length (2-3 sentences)",
-                    "Long": "Create detailed, expressive replies (3-5 sentences)"
-                }
-                
-                prompt = f"""You are an expert communication specialist. Analyze the conversation and generate {num_suggestions} different reply suggestions.
-
-Mood/Tone: {mood_instructions[mood]}
-Reply Length: {length_guide[reply_length]}
-
-Additional Context: {additional_context if additional_context else "None"}
-
-Instructions:
-1. Read the conversation carefully
-2. Generate {num_suggestions} unique replies matching the mood and length
-3. Make replies natural and contextually appropriate
-4. Number each suggestion
-5. Add brief reason after each
-
-Format:
-**Reply 1:**
-[Your reply]
-*Why it works: [Brief explanation]*
-
-**Reply 2:**
-[Your reply]
-*Why it works: [Brief explanation]*
-
-"""
-                
-                # Add conversation context
-                if uploaded_image:
-                    prompt += "\n\nAnalyze the conversation in the image."
-                    if conversation_text:
-                        prompt += f"\n\nAdditional text:\n{conversation_text}"
-                else:
-                    prompt += f"\n\nConversation:\n{conversation_text}"
-                
                 # Use agent system to generate
-                response_text, used_model = agent.generate_with_retry(
-                    prompt,
-                    uploaded_image,
-                    num_suggestions
+                response_text, used_model = generate_replies(
+                    conversation_text,
+                    mood,
+                    reply_length,
+                    num_suggestions,
+                    additional_context,
+                    st.session_state.get('img_hash'),
+                    image=uploaded_image
                 )
                 
                 # Display results